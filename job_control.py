@@ -2,26 +2,39 @@
 places besides control_script.py."""
 import numpy as np
 import os
-from amlt import reasonable_random_structure_maker, PolymorphD3, try_mkdir
+import shlex
+import subprocess
+from amlt import reasonable_random_structure_maker, PolymorphD3
 from ase import io
-from os.path import isfile
+from joblib import Parallel, delayed
 
+rng = np.random.default_rng()
 
 
 def convert_to_traj(filename, traj_name= 'images.traj'):
+    # write under a temporary name so a failed conversion never leaves a
+    # partial trajectory that looks like a finished one
+    part_name = traj_name + '.part'
     try:
         if '.traj' in filename:
             images = io.trajectory.Trajectory( filename, mode = 'r')
         else:
-            images = io.read(filename, index = ':')
+            # stream the ionic steps so long runs are never held in memory
+            images = io.iread(filename, index = ':')
     
-        output_traj = io.trajectory.Trajectory( traj_name, mode = 'w')
-        for atoms in images:
-            output_traj.write(atoms = atoms)
-        output_traj.close()
+        output_traj = io.trajectory.Trajectory( part_name, mode = 'w')
+        try:
+            for atoms in images:
+                output_traj.write(atoms = atoms)
+        finally:
+            output_traj.close()
+        os.replace(part_name, traj_name)
+        images = io.trajectory.Trajectory( traj_name, mode = 'r')
     
-    except:
+    except Exception:
         print('conversion failed! File may be incomplete.')
+        if os.path.exists(part_name):
+            os.remove(part_name)
         images = []
 
     return images
@@ -34,6 +47,52 @@ def outcar_to_traj(outcar_name = 'OUTCAR', traj_name='outcar.traj'):
 
 
 
+def _dir_entries(path):
+    """Maps file names in a directory to their os.DirEntry, empty if the
+    directory doesn't exist yet."""
+    if not os.path.isdir(path):
+        return {}
+    with os.scandir(path) as it:
+        return {entry.name: entry for entry in it}
+
+
+
+
+def _prepare_structure(structure_type,
+                       parameters,
+                       structure_rng = None,
+                       parent = None):
+    """Builds a random or polymorphD3 starting structure without writing
+    anything, so it can run in a worker process.
+
+    Args:
+        structure_type (String): "random" or "polymorphD3"
+        parameters (Dict): random_structure_parameters or
+            polymorphD3_parameters from vasp_job_maker
+        structure_rng (Generator): Generator for this structure only, it
+            replaces any rng in the random structure parameters
+        parent (Atoms): known polymorph that polymorphD3 distorts
+    Returns:
+        atoms (Atoms): the new structure, or the exception raised while
+            building it so one failure doesn't discard the rest of the batch
+    """
+
+    try:
+        if structure_type == 'random':
+            atoms = reasonable_random_structure_maker(**dict(parameters, rng=structure_rng))
+
+        elif structure_type == 'polymorphD3':
+            atoms = PolymorphD3(parent, **parameters).atoms_out
+        else:
+            raise Exception('Structure type "{}" not recognized'.format(structure_type))
+    except Exception as error:
+        return error
+
+    return atoms
+
+
+
+
 def vasp_job_maker(name_prefix,
                    jobs,
                    job_command,
@@ -46,7 +105,8 @@ def vasp_job_maker(name_prefix,
                    polymorphD3_parameters = None,
                    first_structure = 'POSCAR.initial',
                    magmom_filename = 'MAGMOMS.initial',
-                   rebuild_traj_cache = False):
+                   rebuild_traj_cache = False,
+                   n_jobs = -1):
     """Creates VASP input files and controls job submission.
     Args:
         name_prefix (String):
@@ -67,28 +127,33 @@ def vasp_job_maker(name_prefix,
         submit (Boolean): Send jobs to SLURM scheduler if True
         random_structure_parameters (Dict): Control parameters for making
             random structures.  See rrsm.py for details
-        known_structures (List): List of CIF filepaths for known polymorphs
+        known_structures (List): Atoms or CIF filepaths for known polymorphs
         polymorphD3_parameters (Dict): Control parameters for creating
             distorted structures with vacancies and displacements.
             See polymorphD3.py for more details
         first_structure (String): Saved filename of starting structure
         magmom_filename (String): Saved filename of starting magnetic moments
+        n_jobs (Integer): Number of processes used to generate structures,
+            -1 uses all cores. A structure that fails to build is reported
+            and skipped, the others are still written
     """
 
-
-    twd = os.getcwd()
+    # read any filepaths once here rather than for every structure made from them
+    known_structures = [io.read(structure) if isinstance(structure, str) else structure
+                        for structure in known_structures]
 
     total_images = 0
     for job_type in jobs:
 
-        job_type_dir = job_type[1] +'_' + job_type[2] +'/'
+        n_requested, structure_type, calc_type = job_type[:3]
+        job_type_dir = f'{structure_type}_{calc_type}'
 
-        try_mkdir(job_type_dir)
+        os.makedirs(job_type_dir, exist_ok=True)
 
-        if job_type[1] =='known':
+        if structure_type =='known':
             n_structures = len(known_structures)
         else:
-            n_structures = job_type[0]
+            n_structures = n_requested
         
         # set outputfile that will be used for checking job progress
         if len(job_type)>=4:
@@ -96,90 +161,123 @@ def vasp_job_maker(name_prefix,
         else: #default to outcar if nto given
             outputfile = 'OUTCAR'
 
+        # one directory listing per structure instead of a stat per file check,
+        # which adds up on networked scratch filesystems
+        struct_dirs = [os.path.join(job_type_dir, str(structure_number)) for structure_number in range(n_structures)]
+        struct_entries = [_dir_entries(struct_dir) for struct_dir in struct_dirs]
+
+        # Structure generation is cpu bound and independent for each
+        # structure, so it is done in parallel and the files are written below.
+        # All randomness is split up here in the main process, since each task
+        # gets its own pickled copy of the parameters and a shared rng would
+        # start every worker from the same state.
+        to_build = [structure_number for structure_number in range(n_structures)
+                    if first_structure not in struct_entries[structure_number]]
+        new_structures = {}
+        if to_build:
+            if structure_type == 'known':
+                built = [known_structures[structure_number] for structure_number in to_build]
+            else:
+                if structure_type == 'random':
+                    # seeded from the parent so a seeded rng stays reproducible,
+                    # SeedSequence rather than Generator.spawn for NumPy < 1.25
+                    parent_rng = random_structure_parameters.get('rng', rng)
+                    seed_seq = np.random.SeedSequence(parent_rng.integers(2**63))
+                    tasks = [delayed(_prepare_structure)(
+                                structure_type,
+                                random_structure_parameters,
+                                structure_rng = np.random.default_rng(child_seed))
+                             for child_seed in seed_seq.spawn(len(to_build))]
+
+                elif structure_type == 'polymorphD3':
+                    assert len(known_structures)>0
+                    tasks = [delayed(_prepare_structure)(
+                                structure_type,
+                                polymorphD3_parameters,
+                                parent = known_structures[rng.integers(len(known_structures))])
+                             for structure_number in to_build]
+                else:
+                    raise Exception('Structure type "{}" not recognized'.format(structure_type))
+
+                built = Parallel(n_jobs=n_jobs)(tasks)
+            new_structures = dict(zip(to_build, built))
+
         # now we can loop over structures
         job_type_total_images = 0
         for structure_number in range(n_structures):
 
-            struct_dir =job_type_dir + str(structure_number) +'/'
-            try_mkdir(struct_dir)
+            struct_dir = struct_dirs[structure_number]
+            entries = struct_entries[structure_number]
+            os.makedirs(struct_dir, exist_ok=True)
+            first_path = os.path.join(struct_dir, first_structure)
+            output_path = os.path.join(struct_dir, outputfile)
+            traj_path = os.path.join(struct_dir, 'images.traj')
+            label = os.path.join(struct_dir, '').ljust(25)
 
             # If input structure files have not been generated, we need to
             # write a POSCAR and MAGMOM file based on the job type
-            if not isfile(struct_dir+ first_structure):
-
-
-                if job_type[1] == 'random':
-                    atoms = reasonable_random_structure_maker(**random_structure_parameters)
-                    #if callable(random_structure_parameters['magmom_generator']):
-
-                elif job_type[1] == 'polymorphD3':
-                    assert len(known_structures)>0
-                    index = np.random.random_integers(low = 0, high=len(known_structures)-1)
-                    atoms = PolymorphD3(known_structures[index], **polymorphD3_parameters).atoms_out
-
-                elif job_type[1] =='known':
-                    atoms = known_structures[structure_number]
-                else:
-                    raise Exception('Structure type "{}" not recognized'.format(job_type[1]))
-
-                io.write(struct_dir+ first_structure, atoms, format = 'vasp', vasp5=True)
+            if structure_number in new_structures:
+
+                atoms = new_structures[structure_number]
+                if isinstance(atoms, Exception):
+                    # nothing is written, so the next run tries again
+                    print(label, 'structure failed: {}'.format(atoms))
+                    continue
+                io.write(first_path, atoms, format = 'vasp', vasp5=True)
                 magmoms = atoms.get_initial_magnetic_moments()
-                # magmom check
-                if np.sqrt(magmoms.dot(magmoms)) > 0.0000001:
-                    np.savetxt(struct_dir + magmom_filename,  magmoms.T)
+                # magmom check, squared norm against 1e-7**2
+                if magmoms.size and magmoms.dot(magmoms) > 1e-14:
+                    with open(os.path.join(struct_dir, magmom_filename), 'w') as fid:
+                        fid.write('\n'.join(format(m, '.10g') for m in magmoms) + '\n')
 
-                #if job_type[2] == 'md':
-                #    temp = np.random.rand()*(max(md_temperature_range) - min(md_temperature_range)) + min(md_temperature_range)
-                #    np.savetxt(struct_dir+'temperature.txt', [temp,temp])
+                #if calc_type == 'md':
+                #    temp = rng.uniform(min(md_temperature_range), max(md_temperature_range))
+                #    np.savetxt(os.path.join(struct_dir, 'temperature.txt'), [temp,temp])
 
-                print(struct_dir.ljust(25), 'structure created')
+                print(label, 'structure created')
 
 
             # If VASP has not been run yet, we then create the job script for
             # the SLURM job scheduler.
             #if len(job_type)<4:
 
-            if not isfile(struct_dir + outputfile):
+            if outputfile not in entries:
 
-                fid = open(struct_dir+ job_script_name,'w')
-                job_name = "{}_{}_{}_{}".format(
-                        name_prefix,
-                        job_type[1],
-                        job_type[2],
-                        structure_number)
-                fid.write(job_script_template.format(job_name, job_type[2]))
-                fid.close()
+                job_name = f'{name_prefix}_{structure_type}_{calc_type}_{structure_number}'
+                with open(os.path.join(struct_dir, job_script_name),'w') as fid:
+                    fid.write(job_script_template.format(job_name, calc_type))
 
 
                 if submit:
-                    os.chdir(struct_dir)
-                    os.system(job_command+' '+job_script_name)
-                    os.chdir(twd)
-                    print(struct_dir.ljust(25), 'job submitted')
+                    subprocess.run(shlex.split(job_command) + [job_script_name], cwd=struct_dir)
+                    print(label, 'job submitted')
                 else:
-                    print(struct_dir.ljust(25), 'job not yet run')
+                    print(label, 'job not yet run')
             # If VASP has already been run, we can write the resulting ionic
             # steps to ase trajectory files.
             else:
-                if isfile(struct_dir + 'images.traj')==False or rebuild_traj_cache:
+                # the cached trajectory is rebuilt if the job wrote more
+                # output since it was made
+                traj_entry = entries.get('images.traj')
+                if traj_entry is None or rebuild_traj_cache or \
+                        traj_entry.stat().st_mtime < entries[outputfile].stat().st_mtime:
 
                     #what if image writting is interupred? taken care of by function 
-                    images = convert_to_traj(struct_dir + outputfile, struct_dir + 'images.traj')	
+                    images = convert_to_traj(output_path, traj_path)	
 
                 else:
 
-                    size = os.path.getsize(struct_dir + 'images.traj')
+                    size = traj_entry.stat().st_size
                     #print(size)
                     if size > 4:
-                        images = io.trajectory.Trajectory( struct_dir + 'images.traj', mode = 'r')
+                        images = io.trajectory.Trajectory( traj_path, mode = 'r')
                     else:
                         images = []
-                        print('%s was empty.'%(struct_dir + 'images.traj') )
-                print(struct_dir.ljust(25), '  has {:4d} images'.format(len(images)))
+                        print('%s was empty.'% traj_path )
+                print(label, '  has {:4d} images'.format(len(images)))
                 job_type_total_images += len(images)
         
-        jtname = job_type[1] +'_' + job_type[2]
-        print(jtname + ' Subtotal images: %i\n'% job_type_total_images)
+        print(job_type_dir + ' Subtotal images: %i\n'% job_type_total_images)
         total_images += job_type_total_images
     print('Total images: %i'%total_images)
 
@@ -1,70 +1,112 @@
+import functools
+import math
+import warnings
 
+import numpy as np
 
+try:
+    from numba import njit
+except ImportError: # numba is optional, the kernel just runs as plain python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
 
-def get_kpts_from_kpd(atoms, kpd, only_even = False, enforce_mean_plane_density=False, show_kpts = True, atol = 1e-1 ):
-    
-    if only_even:
-        step = 2
+
+
+@njit(cache=True)
+def _isclose(a, b, atol):
+    # same test as np.isclose with the default rtol
+    return abs(a - b) <= atol + 1e-5 * abs(b)
+
+
+
+@njit(cache=True)
+def _argsort3(x, y, z):
+    # stable argsort of three values, matches np.argsort without the overhead
+    if x <= y:
+        if y <= z:
+            return (0, 1, 2)
+        elif x <= z:
+            return (0, 2, 1)
+        else:
+            return (2, 0, 1)
     else:
-        step = 1
-    
-    # tries to keep equi-planar spacing in k-space to match a KPD
-    import numpy as np
-    #kpd = kpoint_density
-    #lengths_angles = atoms.cell.cellpar()
-    vol = atoms.get_volume()
-    lengths = atoms.cell.lengths()
+        if x <= z:
+            return (1, 0, 2)
+        elif y <= z:
+            return (1, 2, 0)
+        else:
+            return (2, 1, 0)
+
+
+
+@njit(cache=True)
+def _kgrid_core(vol, l0, l1, l2, kpd, step, atol, enforce_mean_plane_density, order_by_plane_density):
+    """Rounds the mean k-plane density of a cell to an integer grid.
+
+    Args:
+        vol (Float): cell volume
+        l0, l1, l2 (Float): cell lengths
+        kpd (Float): target k-point density (kpoints * volume)
+        step (Integer): grid increment, 2 keeps the grid even
+        atol (Float): tolerance for treating two axes as equally fractional
+        enforce_mean_plane_density (Boolean): round up instead of down
+            before filling in the target kpd
+        order_by_plane_density (Boolean): round up the lowest plane density
+            axes first, otherwise the axes closest to a whole number
+    Returns:
+        n0, n1, n2 (Integer): number of kpoints along each axis
+    """
+    lengths = np.array((l0, l1, l2))
     ngrid = kpd/vol # BZ volume = 1/cell volume (without 2pi factors)
-    plane_density_mean = (ngrid * lengths[0] * lengths[1] * lengths[2]) ** (1 / 3)
-    #plane_density_mean = (ngrid * vol) ** (1 / 3)
+    plane_density_mean = (ngrid * l0 * l1 * l2) ** (1.0 / 3.0)
 
-    nkpt_frac  = np.zeros(3)
-    nkpt       = np.ones(3)
-    for i, l in enumerate(lengths):
-        nkpt_frac[i] = max(plane_density_mean / l, 1)
+    nkpt_frac = np.empty(3)
+    nkpt      = np.ones(3)
+    for i in range(3):
+        nkpt_frac[i] = max(plane_density_mean / lengths[i], 1.0)
         if nkpt_frac[i]>step: #we can only round down to the bare minimum right?
             if enforce_mean_plane_density:
-                nkpt[i] = np.ceil(nkpt_frac[i]/step)*step
+                nkpt[i] = math.ceil(nkpt_frac[i]/step)*step
             else:
-                nkpt[i] = np.floor(nkpt_frac[i]/step)*step
-    
-    #print(nkpt_frac,'->',nkpt)
-    #nkpt       = np.floor(nkpt_frac)
+                nkpt[i] = math.floor(nkpt_frac[i]/step)*step
+
     actual_kpd = vol * nkpt[0]*nkpt[1]*nkpt[2]
-    
-    if True:
-        plane_densities = lengths*nkpt
-        #print(plane_densities)
+
+    if order_by_plane_density:
         # we want to start with the largest plane spacing, not the one closest to another integer
-        check_order = np.argsort( plane_densities)
+        x, y, z = l0*nkpt[0], l1*nkpt[1], l2*nkpt[2]
     else:
-        delta_ceil = np.ceil(nkpt_frac)-nkpt_frac # measure of which axes are closer to a whole number
-        check_order = np.argsort(delta_ceil) # we do this so we keep the grid as even as possible only rounding up when they are close
-
-    
-
+        # measure of which axes are closer to a whole number, so we keep the
+        # grid as even as possible only rounding up when they are close
+        x = math.ceil(nkpt_frac[0]) - nkpt_frac[0]
+        y = math.ceil(nkpt_frac[1]) - nkpt_frac[1]
+        z = math.ceil(nkpt_frac[2]) - nkpt_frac[2]
+
+    check_order = _argsort3(x, y, z)
+    a, b, c = check_order
     i = 0 # tracks which index we checked
     if actual_kpd < kpd:
-        if np.isclose(nkpt_frac[check_order[0]], nkpt_frac[check_order[1]], atol=atol) and \
-            np.isclose(nkpt_frac[check_order[1]], nkpt_frac[check_order[2]], atol=atol):
-                nkpt[check_order[0]] = nkpt[check_order[0]] +step
-                nkpt[check_order[1]] = nkpt[check_order[1]] +step
-                nkpt[check_order[2]] = nkpt[check_order[2]] +step
-                actual_kpd = vol * nkpt[0]*nkpt[1]*nkpt[2]
-                i = 3
+        if _isclose(nkpt_frac[a], nkpt_frac[b], atol) and _isclose(nkpt_frac[b], nkpt_frac[c], atol):
+            nkpt[a] = nkpt[a] +step
+            nkpt[b] = nkpt[b] +step
+            nkpt[c] = nkpt[c] +step
+            actual_kpd = vol * nkpt[0]*nkpt[1]*nkpt[2]
+            i = 3
 
-        elif np.isclose(nkpt_frac[check_order[0]], nkpt_frac[check_order[1]], atol=atol):
-            nkpt[check_order[0]] = nkpt[check_order[0]] +step
-            nkpt[check_order[1]] = nkpt[check_order[1]] +step
+        elif _isclose(nkpt_frac[a], nkpt_frac[b], atol):
+            nkpt[a] = nkpt[a] +step
+            nkpt[b] = nkpt[b] +step
             actual_kpd = vol * nkpt[0]*nkpt[1]*nkpt[2]
             i = 2
 
-        elif np.isclose(nkpt_frac[check_order[1]], nkpt_frac[check_order[2]], atol=atol):
-            nkpt[check_order[0]] = nkpt[check_order[0]] +step
+        elif _isclose(nkpt_frac[b], nkpt_frac[c], atol):
+            nkpt[a] = nkpt[a] +step
             actual_kpd = vol * nkpt[0]*nkpt[1]*nkpt[2]
             if actual_kpd < kpd:
-                nkpt[check_order[1]] = nkpt[check_order[1]] +step
-                nkpt[check_order[2]] = nkpt[check_order[2]] +step
+                nkpt[b] = nkpt[b] +step
+                nkpt[c] = nkpt[c] +step
                 actual_kpd = vol * nkpt[0]*nkpt[1]*nkpt[2]
             i = 3
 
@@ -73,9 +115,43 @@ def get_kpts_from_kpd(atoms, kpd, only_even = False, enforce_mean_plane_density=
         actual_kpd = vol * nkpt[0]*nkpt[1]*nkpt[2]
         i+=1
 
-    kpts = [int(nkpt[i]) for i in range(3)]
+    return int(nkpt[0]), int(nkpt[1]), int(nkpt[2])
+
+
+
+@functools.lru_cache(maxsize=4096)
+def _kgrid_cached(vol, l0, l1, l2, kpd, step, atol, enforce_mean_plane_density, order_by_plane_density):
+    # generated structures often repeat a cell, so repeat grids become a lookup.
+    # The key is the exact floats, rounding them can flip ties between axes.
+    return _kgrid_core(vol, l0, l1, l2, kpd, step, atol, enforce_mean_plane_density, order_by_plane_density)
+
+
+
+def _kgrid(use_cache, *args):
+    if use_cache:
+        return _kgrid_cached(*args)
+    return _kgrid_core(*args)
+
+
+
+def get_kpts_from_kpd(atoms, kpd, only_even = False, enforce_mean_plane_density=False, show_kpts = True, atol = 1e-1, use_cache = True ):
     
+    if only_even:
+        step = 2
+    else:
+        step = 1
+    
+    # tries to keep equi-planar spacing in k-space to match a KPD
+    #kpd = kpoint_density
+    vol = atoms.get_volume()
+    lengths = atoms.cell.lengths()
+    l0, l1, l2 = float(lengths[0]), float(lengths[1]), float(lengths[2])
+    kpts = list(_kgrid(use_cache, vol, l0, l1, l2, float(kpd), step, atol,
+                       bool(enforce_mean_plane_density), True))
+
     if show_kpts:
+        plane_density_mean = (kpd/vol * l0 * l1 * l2) ** (1 / 3)
+        actual_kpd = vol * kpts[0]*kpts[1]*kpts[2]
         print('kgrid: %i x %i x %i'%tuple(kpts))
         print('kpd target: %.3f, actual kpd: %.3f'%(kpd, actual_kpd))
         print('k-plane target: %.3f'%  plane_density_mean)
@@ -85,64 +161,14 @@ def get_kpts_from_kpd(atoms, kpd, only_even = False, enforce_mean_plane_density=
 
 
 
-import warnings
-
-
-
-def safe_kgrid_from_cell_volume(atoms, kpoint_density):
-    import numpy as np
+def safe_kgrid_from_cell_volume(atoms, kpoint_density, use_cache = True):
     print( "safe_kgrid_from_cell_volume is depricated, use get_kpts_from_kpd" )
     warnings.warn("safe_kgrid_from_cell_volume is depricated, use get_kpts_from_kpd", DeprecationWarning)
 
-    kpd = kpoint_density
-    lengths_angles = atoms.get_cell_lengths_and_angles()
+    lengths = atoms.cell.cellpar()[:3]
     vol = atoms.get_volume()
-    lengths = lengths_angles[0:3]
-    ngrid = kpd/vol # BZ volume = 1/cell volume (without 2pi factors)
-    mult = (ngrid * lengths[0] * lengths[1] * lengths[2]) ** (1 / 3)
-
-    nkpt_frac  = np.zeros(3)
-    for i, l in enumerate(lengths):
-        nkpt_frac[i] = max(mult / l, 1)
-        
-    nkpt       = np.floor(nkpt_frac)
-    delta_ceil = np.ceil(nkpt_frac)-nkpt_frac # measure of which axes are closer to a whole number
-
-    actual_kpd = vol * nkpt[0]*nkpt[1]*nkpt[2]
-
-    check_order = np.argsort(delta_ceil) # we do this so we keep the grid as even as possible only rounding up when they are close
-
-
-    i = 0
-    if actual_kpd < kpd:
-        if np.isclose(nkpt_frac[check_order[0]], nkpt_frac[check_order[1]]) and np.isclose(nkpt_frac[check_order[1]], nkpt_frac[check_order[2]]):
-            nkpt[check_order[0]] = nkpt[check_order[0]] +1
-            nkpt[check_order[1]] = nkpt[check_order[1]] +1
-            nkpt[check_order[2]] = nkpt[check_order[2]] +1
-            actual_kpd = vol * nkpt[0]*nkpt[1]*nkpt[2]
-            i = 3
-
-        elif np.isclose(nkpt_frac[check_order[0]], nkpt_frac[check_order[1]]):
-            nkpt[check_order[0]] = nkpt[check_order[0]] +1
-            nkpt[check_order[1]] = nkpt[check_order[1]] +1
-            actual_kpd = vol * nkpt[0]*nkpt[1]*nkpt[2]
-            i = 2
-
-        elif np.isclose(nkpt_frac[check_order[1]], nkpt_frac[check_order[2]]):
-            nkpt[check_order[0]] = nkpt[check_order[0]] +1
-            actual_kpd = vol * nkpt[0]*nkpt[1]*nkpt[2]
-            if actual_kpd < kpd:
-                nkpt[check_order[1]] = nkpt[check_order[1]] +1
-                nkpt[check_order[2]] = nkpt[check_order[2]] +1
-                actual_kpd = vol * nkpt[0]*nkpt[1]*nkpt[2]
-            i = 3
-
-    while actual_kpd < kpd and i<=2:
-        nkpt[check_order[i]] = nkpt[check_order[i]] +1
-        actual_kpd = vol * nkpt[0]*nkpt[1]*nkpt[2]
-        i+=1
-
-    kp_as_ints = [int(nkpt[i]) for i in range(3)]
+    kp_as_ints = list(_kgrid(use_cache, vol, float(lengths[0]), float(lengths[1]), float(lengths[2]),
+                             float(kpoint_density), 1, 1e-8, False, False))
     return kp_as_ints
 
 
@@ -150,22 +176,22 @@ def safe_kgrid_from_cell_volume(atoms, kpoint_density):
 
 
 def kgrid_from_cell_volume(atoms, kpoint_density ):
-	import math
 	kpd = kpoint_density
-	lengths_angles = atoms.get_cell_lengths_and_angles()
+	lengths = atoms.cell.cellpar()[:3]
+	vol = atoms.get_volume()
 	#if math.fabs((math.floor(kppa ** (1 / 3) + 0.5)) ** 3 - kppa) < 1:
 	#    kppa += kppa * 0.01
-	lengths = lengths_angles[0:3]
-	ngrid = kpd/atoms.get_volume() # BZ volume = 1/cell volume (withot 2pi factors)
+	ngrid = kpd/vol # BZ volume = 1/cell volume (withot 2pi factors)
 	mult = (ngrid * lengths[0] * lengths[1] * lengths[2]) ** (1 / 3)
+	nkpt_frac = mult / lengths
 
-	num_divf = [int(math.floor(max(mult / l, 1))) for l in lengths]
-	kpdf = atoms.get_volume()*num_divf[0]*num_divf[1]*num_divf[2]
+	num_divf = np.floor(np.maximum(nkpt_frac, 1.0)).astype(int).tolist()
+	kpdf = vol*num_divf[0]*num_divf[1]*num_divf[2]
 	errorf = abs(kpd - kpdf)/kpdf # not a type being 0.5 is much worse than being 1.5
 
 
-	num_divc = [int(math.ceil(mult / l)) for l in lengths]
-	kpdc = atoms.get_volume()*num_divc[0]*num_divc[1]*num_divc[2]
+	num_divc = np.ceil(nkpt_frac).astype(int).tolist()
+	kpdc = vol*num_divc[0]*num_divc[1]*num_divc[2]
 	errorc = abs(kpd - kpdc)/kpdc #same
 
 	if errorc < errorf :
@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+from ase import io
+from ase.build import bulk
+
+from amlt.job_control import vasp_job_maker
+
+
+job_script_template = '#!/bin/bash\n#SBATCH --job-name={}\npython ../../{}.py\n'
+
+
+def make_jobs(jobs, **kwargs):
+    vasp_job_maker(name_prefix = 'test',
+                   jobs = jobs,
+                   job_command = 'sbatch',
+                   job_script_name = 'job.sbatch',
+                   job_script_template = job_script_template,
+                   **kwargs)
+
+
+def test_parallel_random_structures_differ(tmp_path, monkeypatch):
+    # a seeded rng in the parameters must not be copied into every worker
+    monkeypatch.chdir(tmp_path)
+    random_structure_parameters = dict(
+            elements = ['O', 'Si'],
+            cell = 8.0,
+            fill_factor_max = 0.40,
+            fill_factor_min = 0.10,
+            rng = np.random.default_rng(1234))
+    n_structures = 6
+    make_jobs([[n_structures, 'random', 'sp']],
+              random_structure_parameters = random_structure_parameters,
+              n_jobs = 2)
+
+    poscars = set()
+    for structure_number in range(n_structures):
+        with open(os.path.join('random_sp', str(structure_number), 'POSCAR.initial')) as fid:
+            poscars.add(fid.read())
+    assert len(poscars) == n_structures
+
+
+def flaky_composition(rng):
+    if rng.random() < 0.5:
+        raise ValueError('no composition')
+    return np.array([0.5, 0.5])
+
+
+def test_failed_structure_does_not_discard_batch(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    random_structure_parameters = dict(
+            elements = ['O', 'Si'],
+            cell = 8.0,
+            fill_factor_max = 0.40,
+            fill_factor_min = 0.10,
+            composition_generator = flaky_composition,
+            rng = np.random.default_rng(1234))
+    n_structures = 6
+    make_jobs([[n_structures, 'random', 'sp']],
+              random_structure_parameters = random_structure_parameters,
+              n_jobs = 1)
+
+    out = capsys.readouterr().out
+    written = [os.path.exists(os.path.join('random_sp', str(structure_number), 'POSCAR.initial'))
+               for structure_number in range(n_structures)]
+    assert out.count('structure failed: no composition') == written.count(False)
+    assert 0 < sum(written) < n_structures
+
+
+def test_failed_conversion_is_retried(tmp_path, monkeypatch, capsys):
+    # a truncated output must not leave a trajectory that later runs count
+    monkeypatch.chdir(tmp_path)
+    frames = [bulk('Cu') * (1, 1, i + 1) for i in range(5)]
+    jobs = [[0, 'known', 'sp', 'output.xyz']]
+    make_jobs(jobs, known_structures = [bulk('Cu')])
+
+    output_path = os.path.join('known_sp', '0', 'output.xyz')
+    traj_path = os.path.join('known_sp', '0', 'images.traj')
+    io.write(output_path, frames)
+    with open(output_path, 'a') as fid:
+        fid.write('garbage\n')
+
+    for run in range(2):
+        capsys.readouterr()
+        make_jobs(jobs, known_structures = [bulk('Cu')])
+        out = capsys.readouterr().out
+        assert 'conversion failed!' in out
+        assert 'has    0 images' in out
+        assert not os.path.exists(traj_path)
+        assert not os.path.exists(traj_path + '.part')
+
+    io.write(output_path, frames)
+    make_jobs(jobs, known_structures = [bulk('Cu')])
+    assert 'has    5 images' in capsys.readouterr().out
+    assert len(io.read(traj_path, index = ':')) == 5
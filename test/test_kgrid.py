@@ -86,3 +86,15 @@ kpts = get_kpts_from_kpd(atoms,kpd,only_even=True)
 print('-----test 3 only_even + enforce_mean_plane_density-----')
 kpts = get_kpts_from_kpd(atoms,kpd,only_even=True, enforce_mean_plane_density=True)
 print()
+
+
+
+def test_cached_kgrid_matches_uncached():
+    # lengths a, a, 3a tie the plane densities exactly, so any change to the
+    # inputs on the way into the cache would flip the rounding order
+    atoms = Atoms('H', cell=[5.639814654603079]*2 + [16.919443963809236, 90, 90, 90])
+    for only_even in (False, True):
+        uncached = get_kpts_from_kpd(atoms, 8000, only_even=only_even, show_kpts=False, use_cache=False)
+        assert get_kpts_from_kpd(atoms, 8000, only_even=only_even, show_kpts=False) == uncached
+        assert get_kpts_from_kpd(atoms, 8000, only_even=only_even, show_kpts=False) == uncached
+    assert get_kpts_from_kpd(atoms, 8000, show_kpts=False) == [4, 4, 1]